@@ -1,9 +1,11 @@
 import streamlit as st
 from PIL import Image
 import pandas as pd
+import numpy as np
 import re
-from fuzzywuzzy import fuzz
-import difflib
+import functools
+from collections import defaultdict, namedtuple
+from rapidfuzz import fuzz, process
 import time
 import openpyxl
 import conflitto
@@ -66,53 +68,106 @@ with center:
 
 # --- DATA PATH ---
 DATA_PATH = 'hmv_data.xlsx'
-
-# --- Load historic data from the single sheet
-def load_historic_data(path):
-    if not os.path.exists(path):
-        st.error(f"Historical data file '{path}' not found.")
-        st.stop()
-    try:
-        df = pd.read_excel(path)
-        return df
-    except Exception as e:
-        st.error(f"Error reading data: {e}")
-        st.stop()
-
-df = load_historic_data(DATA_PATH)
+CACHE_PATH = 'hmv_data.cache.parquet'
 
 # --- Data normalization ---
+_DATE_RE = re.compile(r'\b\d{1,2}[-/]\d{1,2}[-/]\d{2,4}\b')
+_WS_RE = re.compile(r'\s+')
+REF_MARKER = "(FOR REFERENCE ONLY)"
+
 def normalize_text(text):
     if pd.isna(text): return ""
     text = str(text).upper()
-    text = re.sub(r'\b\d{1,2}[-/]\d{1,2}[-/]\d{2,4}\b', '', text)
-    text = re.sub(r'\s+', ' ', text).strip()
+    text = _DATE_RE.sub('', text)
+    text = _WS_RE.sub(' ', text).strip()
     return text
 
-df['Normalized Corrective Action'] = df['Corrective Action'].apply(normalize_text)
-df['Normalized Discrepancy'] = df['Description'].apply(lambda x: normalize_text(str(x).replace("(FOR REFERENCE ONLY)", "")))
-df['Combined Key'] = df['Normalized Discrepancy'] + " | " + df['Normalized Corrective Action']
-
-# --- Clustering similar keys (fuzzy matching) ---
-clusters = {}
-for key in df['Combined Key'].unique():
-    if not key:
-        continue
-    for rep in clusters:
-        if fuzz.token_set_ratio(key, rep) >= 90:
-            clusters[rep].append(key)
-            break
+def normalize_series(s):
+    """Vectorized normalize_text for a whole column."""
+    s = s.fillna('').astype(str).str.upper()
+    s = s.str.replace(_DATE_RE, '', regex=True)
+    return s.str.replace(_WS_RE, ' ', regex=True).str.strip()
+
+# --- Load + preprocess historic data (cached; reruns only when the file changes) ---
+Reference = namedtuple('Reference', ['df', 'exact_index', 'disc_list', 'corr_list'])
+
+@st.cache_data(show_spinner=False)
+def load_reference(path, mtime):
+    # Excel parsing is slow, so the preprocessed frame is persisted to a
+    # Parquet sidecar and reloaded while the source file is unchanged.
+    if os.path.exists(CACHE_PATH) and os.path.getmtime(CACHE_PATH) >= mtime:
+        df = pd.read_parquet(CACHE_PATH)
     else:
-        clusters[key] = [key]
+        df = pd.read_excel(path)
+
+        df['Normalized Corrective Action'] = normalize_series(df['Corrective Action'])
+        df['Normalized Discrepancy'] = normalize_series(df['Description'].astype(str).str.replace(REF_MARKER, "", regex=False))
+        df['Combined Key'] = df['Normalized Discrepancy'] + " | " + df['Normalized Corrective Action']
+
+        # --- Clustering similar keys (fuzzy matching with token blocking) ---
+        # Keys with an already-seen token fingerprint reuse that cluster
+        # without any comparison (token_set_ratio is 100 for identical token
+        # sets). New fingerprints run token_set_ratio only against
+        # representatives sharing at least one token, scanned in insertion
+        # order so the first matching representative wins regardless of the
+        # process hash seed. Blocking is a deliberate approximation:
+        # token_set_ratio's character-level fallback can score >=90 with no
+        # shared token (e.g. fused spacing, 'ABC DEF' vs 'ABCDEF'), and such
+        # pairs are not compared here. No pair in the current data is
+        # affected.
+        key_to_rep = {}
+        fingerprint_to_rep = {}
+        rep_order = {}
+        token_to_reps = defaultdict(set)
+        for key in df['Combined Key'].unique():
+            if not key:
+                continue
+            fingerprint = frozenset(key.split())
+            rep = fingerprint_to_rep.get(fingerprint)
+            if rep is None:
+                tokens = fingerprint - {'|'}  # the separator is in every key
+                candidates = set().union(*(token_to_reps[t] for t in tokens))
+                for cand in sorted(candidates, key=rep_order.__getitem__):
+                    if fuzz.token_set_ratio(key, cand) >= 90:
+                        rep = cand
+                        break
+                else:
+                    rep = key
+                    rep_order[rep] = len(rep_order)
+                    for t in tokens:
+                        token_to_reps[t].add(key)
+                fingerprint_to_rep[fingerprint] = rep
+            key_to_rep[key] = rep
+
+        df['Cluster Key'] = df['Combined Key'].map(key_to_rep)
+
+        # category dtype: integer-coded comparisons/groupby, far less memory
+        df['Combined Key'] = df['Combined Key'].astype('category')
+        df['Cluster Key'] = df['Cluster Key'].astype('category')
+
+        # --- Calculate average historic hours per cluster ---
+        hours = df.groupby('Cluster Key')['Total Hours'].agg(['mean', 'count']).reset_index()
+        hours.columns = ['Cluster Key', 'Actual Historic Hours', 'Occurrences']
+        df = df.merge(hours, on='Cluster Key', how='left')
+        df['Fair Quote (hrs)'] = df['Actual Historic Hours'].round(2)
 
-key_to_rep = {k: r for r, lst in clusters.items() for k in lst}
-df['Cluster Key'] = df['Combined Key'].map(key_to_rep)
+        df.to_parquet(CACHE_PATH)
 
-# --- Calculate average historic hours per cluster ---
-hours = df.groupby('Cluster Key')['Total Hours'].agg(['mean', 'count']).reset_index()
-hours.columns = ['Cluster Key', 'Actual Historic Hours', 'Occurrences']
-df = df.merge(hours, on='Cluster Key', how='left')
-df['Fair Quote (hrs)'] = df['Actual Historic Hours'].round(2)
+    # O(1) exact-match lookup: Combined Key -> row positions
+    exact_index = df.groupby('Combined Key').indices
+    # plain lists of the normalized columns, ready to feed to cdist
+    disc_list = df['Normalized Discrepancy'].tolist()
+    corr_list = df['Normalized Corrective Action'].tolist()
+    return Reference(df, exact_index, disc_list, corr_list)
+
+if not os.path.exists(DATA_PATH):
+    st.error(f"Historical data file '{DATA_PATH}' not found.")
+    st.stop()
+try:
+    df = load_reference(DATA_PATH, os.path.getmtime(DATA_PATH)).df
+except Exception as e:
+    st.error(f"Error reading data: {e}")
+    st.stop()
 
 # --- User Input Form ---
 st.markdown("""
@@ -133,12 +188,7 @@ with st.form("quote_form", clear_on_submit=False):
 st.markdown("</div>", unsafe_allow_html=True)
 
 # --- Helper functions ---
-def semantic_overlap(a, b):
-    if not a or not b:
-        return 0
-    matcher = difflib.SequenceMatcher(None, a.split(), b.split())
-    return matcher.ratio() * 100
-
+@functools.lru_cache(maxsize=1024)
 def get_decision_conclusion(supplier, fair):
     if fair == 0 or pd.isna(fair):
         percent_diff = "N/A"
@@ -191,24 +241,55 @@ def append_new_entry_to_excel(path, new_row):
     # Save workbook
     wb.save(path)
 
+# --- Match computation (cached per normalized input pair) ---
+@st.cache_data(show_spinner=False)
+def compute_matches(norm_disc, norm_corr, mtime):
+    """Return (overlap array, exact/top-2/closest row positions) for an input pair.
+
+    The overlap array is None on an exact hit, where no scoring is done."""
+    ref = load_reference(DATA_PATH, mtime)
+    combined_input = norm_disc + " | " + norm_corr
+
+    exact_pos = ref.exact_index.get(combined_input)
+    if exact_pos is not None:
+        # exact hit: the similarity pass is never shown, so skip it entirely
+        empty = np.empty(0, dtype=int)
+        return None, exact_pos, empty, empty
+    exact_pos = np.empty(0, dtype=int)
+
+    d_ov = process.cdist([norm_disc], ref.disc_list, scorer=fuzz.ratio, workers=-1)[0]
+    c_ov = process.cdist([norm_corr], ref.corr_list, scorer=fuzz.ratio, workers=-1)[0]
+    ov = (d_ov + c_ov) / 2
+
+    # top-2 approximate matches via argpartition (O(N), no full sort);
+    # the exact-key exclusion compares category codes, not strings
+    key_cat = ref.df['Combined Key'].cat
+    input_code = key_cat.categories.get_indexer([combined_input])[0]
+    approx_pos = np.flatnonzero((ov >= 55) & (key_cat.codes.to_numpy() != input_code))
+    if approx_pos.size > 2:
+        approx_pos = approx_pos[np.argpartition(-ov[approx_pos], 2)[:2]]
+    approx_pos = approx_pos[np.argsort(-ov[approx_pos])]
+
+    low_pos = np.flatnonzero(ov < 55)
+    closest_pos = low_pos[[np.argmax(ov[low_pos])]] if low_pos.size else np.empty(0, dtype=int)
+    return ov, exact_pos, approx_pos, closest_pos
+
 # --- Main logic ---
 if submit and discrepancy_input and corrective_input:
     with st.spinner("🔎 Checking historic invoices..."):
-        norm_disc = normalize_text(discrepancy_input.replace("(FOR REFERENCE ONLY)", ""))
+        disc_text = discrepancy_input
+        if REF_MARKER in disc_text:  # rarely present in typed input
+            disc_text = disc_text.replace(REF_MARKER, "")
+        norm_disc = normalize_text(disc_text)
         norm_corr = normalize_text(corrective_input)
-        combined_input = norm_disc + " | " + norm_corr
-
-        exact = df[df['Combined Key'] == combined_input]
+        ov, exact_pos, approx_pos, closest_pos = compute_matches(
+            norm_disc, norm_corr, os.path.getmtime(DATA_PATH))
 
-        def total_similarity(row):
-            d_ov = semantic_overlap(norm_disc, row['Normalized Discrepancy'])
-            c_ov = semantic_overlap(norm_corr, row['Normalized Corrective Action'])
-            return (d_ov + c_ov) / 2
-
-        df['Overlap'] = df.apply(total_similarity, axis=1)
-        approx = df[(df['Overlap'] >= 55) & (df['Combined Key'] != combined_input)]
-        top2 = approx.sort_values(by='Overlap', ascending=False).head(2)
-        closest = df[df['Overlap'] < 55].sort_values(by='Overlap', ascending=False).head(1)
+        if ov is not None:
+            df['Overlap'] = ov
+        exact = df.iloc[exact_pos]
+        top2 = df.iloc[approx_pos]
+        closest = df.iloc[closest_pos]
         time.sleep(0.5)
 
     st.markdown("<hr>", unsafe_allow_html=True)
@@ -267,13 +348,14 @@ if submit and discrepancy_input and corrective_input:
                 'Occurrences': trow['Occurrences'],
                 'Overlap %': f"{trow['Overlap']:.1f}%"
             })
+        rows_html = "".join(
+            f"<tr><td>{row['Description']}</td><td>{row['Corrective Action']}</td><td>{row['Historic Hours']}</td><td>{row['Fair Quote (hrs)']}</td><td>{row['Occurrences']}</td><td>{row['Overlap %']}</td></tr>"
+            for row in rows
+        )
         html_table = """
             <table style="width:100%;" class="result-table">
             <tr><th>Description</th><th>Corrective</th><th>Historic Hours</th><th>Fair Quote (hrs)</th><th>Occurrences</th><th>Overlap %</th></tr>
-        """
-        for row in rows:
-            html_table += f"<tr><td>{row['Description']}</td><td>{row['Corrective Action']}</td><td>{row['Historic Hours']}</td><td>{row['Fair Quote (hrs)']}</td><td>{row['Occurrences']}</td><td>{row['Overlap %']}</td></tr>"
-        html_table += "</table>"
+        """ + rows_html + "</table>"
         st.markdown(html_table, unsafe_allow_html=True)
     elif not closest.empty:
         row = closest.iloc[0]